@@ -1,52 +1,300 @@
-import time
-from queue import Queue
+from time import monotonic as _mono
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, groupby
+from operator import itemgetter
+import queue
 import threading
 import random
-from djitellopy import Tello
+from enum import IntEnum
 import logging
 
+class DrumType(IntEnum):
+    """Drum types that trigger dance moves"""
+    KICK = 0
+    SNARE = 1
+    HIHAT = 2
+    TOMS = 3
+    OTHER = 4
+
+# Detector band name -> drum type; anything unknown dances as OTHER
+_DRUM_STR_TO_INT = {
+    'kick': DrumType.KICK,
+    'snare': DrumType.SNARE,
+    'hihat': DrumType.HIHAT,
+    'toms': DrumType.TOMS,
+}
+
+# Moves for each drum type, indexed by DrumType
+_DRUM_MOVES = (
+    ('move_up', 'move_down'),  # Vertical movements for bass drums
+    ('move_left', 'move_right'),  # Horizontal movements for snare
+    ('rotate_clockwise', 'rotate_counter_clockwise'),  # Rotations for hi-hats
+    ('move_forward', 'move_back'),  # Forward/back for toms
+    ('flip_forward', 'flip_back', 'flip_left', 'flip_right'),  # Default flips
+)
+
+# Move kinds, stored alongside each move so the beat path never inspects move names
+MOVE, ROTATE, FLIP = 0, 1, 2
+
+# Human-readable description template for each move
+_MOVE_DESCRIPTIONS = {
+    'rotate_clockwise': "Rotating {}° clockwise",
+    'rotate_counter_clockwise': "Rotating {}° counter-clockwise",
+    'move_forward': "Moving forward {}cm",
+    'move_back': "Moving back {}cm",
+    'move_left': "Moving left {}cm",
+    'move_right': "Moving right {}cm",
+    'move_up': "Moving up {}cm",
+    'move_down': "Moving down {}cm",
+    'flip_forward': "Flipping forward",
+    'flip_back': "Flipping back",
+    'flip_left': "Flipping left",
+    'flip_right': "Flipping right",
+}
+
+class _SimBackend:
+    """Simulated drone that only tracks its height"""
+    move_label = "Simulated move"
+    
+    def __init__(self):
+        self.current_height = 0
+        
+        # Move name -> handler, so executing a move is a single dict lookup.
+        # Only moves that change simulated state need a handler.
+        self._dispatch = {
+            'move_up': self._move_up,
+            'move_down': self._move_down,
+        }
+        
+    def connect(self):
+        """Pretend to connect"""
+        print("Drone connected (SIMULATION MODE)")
+        
+    def takeoff(self):
+        """Pretend to take off"""
+        print("Taking off... (SIMULATION MODE)")
+        self.current_height = 100  # Initial height in cm
+        
+    def land(self):
+        """Pretend to land"""
+        print("Landing... (SIMULATION MODE)")
+        self.current_height = 0
+        
+    def do_move(self, move, value, kind):
+        """Execute a simulated dance move; kind is unused since flips don't change simulated state"""
+        handler = self._dispatch.get(move)
+        if handler is not None:
+            handler(value)
+            
+    def _move_up(self, value):
+        """Simulate climbing by the given distance"""
+        self.current_height += value
+        
+    def _move_down(self, value):
+        """Simulate descending by the given distance without going below the ground"""
+        self.current_height = max(0, self.current_height - value)
+
+class _RealBackend:
+    """DJI Tello driven through djitellopy, with commands sent from a background thread"""
+    move_label = "Real drone move"
+    current_height = 0  # Height is only tracked in simulation
+    
+    def __init__(self, logger, max_queue_size):
+        self.logger = logger
+        
+        # The Tello and its command table are created on connect()
+        self.drone = None
+        self._dispatch = {}
+        
+        # Commands are sent from a background thread so the beat thread never waits on the network
+        self._tx_q = queue.Queue(maxsize=max_queue_size)
+        self._tx_thread = None
+        self._tx_stop = threading.Event()  # Set while no sender should run; replaced on each start
+        self._tx_stop.set()
+        
+    def connect(self):
+        """Create the Tello on first use and connect to it"""
+        if self.drone is None:
+            # Deferred so simulation runs never import djitellopy or open its sockets
+            from djitellopy import Tello
+            self.drone = Tello()
+            
+            # Move name -> Tello command
+            self._dispatch = {
+                'rotate_clockwise': self.drone.rotate_clockwise,
+                'rotate_counter_clockwise': self.drone.rotate_counter_clockwise,
+                'move_forward': self.drone.move_forward,
+                'move_back': self.drone.move_back,
+                'move_left': self.drone.move_left,
+                'move_right': self.drone.move_right,
+                'move_up': self.drone.move_up,
+                'move_down': self.drone.move_down,
+                'flip_forward': self.drone.flip_forward,
+                'flip_back': self.drone.flip_back,
+                'flip_left': self.drone.flip_left,
+                'flip_right': self.drone.flip_right,
+            }
+        self.drone.connect()
+        print("Connected to Tello drone")
+        
+    def takeoff(self):
+        """Take off and start sending dance moves"""
+        self.drone.takeoff()
+        self._start_sender()
+        
+    def land(self):
+        """Stop sending dance moves and land"""
+        self._stop_sender()
+        self.drone.land()
+        
+    def do_move(self, move, value, kind):
+        """Hand a real dance move to the sender thread"""
+        try:
+            command = self._dispatch[move]
+            self._send(command, () if kind == FLIP else (value,))
+        except Exception as e:
+            self.logger.warning("Could not queue dance move %s: %s", move, e)
+            
+    def _start_sender(self):
+        """Start the background thread that sends queued commands to the drone"""
+        if not self._tx_stop.is_set():
+            return
+        if self._tx_thread is not None and self._tx_thread.is_alive():
+            # A sender that outlived the last land() exits as soon as its command returns
+            self._tx_thread.join(timeout=self.drone.RESPONSE_TIMEOUT + 1)
+            if self._tx_thread.is_alive():
+                self.logger.warning("Previous drone command sender is still finishing a command")
+        # Drop anything a beat slipped in while the last land() was stopping the sender
+        self._drain_queue()
+        # Each sender gets its own stop flag, so a late one can never pick up the new session's moves
+        self._tx_stop = threading.Event()
+        self._tx_thread = threading.Thread(target=self._tx_loop, args=(self._tx_stop,), daemon=True)
+        self._tx_thread.start()
+        
+    def _stop_sender(self):
+        """Discard pending commands and wait for the sender thread to finish its current one"""
+        self._tx_stop.set()  # Also makes _send drop any move that arrives while landing
+        self._drain_queue()
+        if self._tx_thread is None:
+            return
+        self._tx_thread.join(timeout=self.drone.RESPONSE_TIMEOUT + 1)
+        if self._tx_thread.is_alive():
+            # djitellopy retries failed commands, so the one in flight can outlast the join
+            self.logger.warning("Drone command sender is still finishing a command; landing anyway")
+        
+    def _drain_queue(self):
+        """Discard every pending command"""
+        while True:
+            try:
+                self._tx_q.get_nowait()
+            except queue.Empty:
+                break
+                
+    def _tx_loop(self, stop):
+        """Send queued (command, args) pairs to the drone until stop is set"""
+        while not stop.is_set():
+            try:
+                command, args = self._tx_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if stop.is_set():
+                break
+            try:
+                command(*args)
+            except Exception as e:
+                # A missed dance move is better than stalling the sender, so never retry
+                self.logger.warning("Dance move %s%s failed: %s", command.__name__, args, e)
+                
+    def _send(self, command, args):
+        """Hand a command to the sender thread, dropping the oldest pending command if it is backed up"""
+        if self._tx_stop.is_set():
+            return
+        try:
+            self._tx_q.put_nowait((command, args))
+        except queue.Full:
+            try:
+                self._tx_q.get_nowait()
+            except queue.Empty:
+                pass
+            self._tx_q.put_nowait((command, args))
+
 class DroneController:
-    def __init__(self, simulation_mode=False):
+    def __init__(self, simulation_mode=False, seed=None, move_weights=None):
         self.simulation_mode = simulation_mode
         self.is_flying = False
-        self.current_height = 0
-        self.counter = 0
         self.last_command_time = 0
         self.min_command_interval = 0.1  # Minimum time between moves
-        self.command_queue = []
+        # Repeats of the same drum within this time after a move are dropped; must exceed the
+        # detector's min_beat_interval (0.3 s) to have any effect
+        self.coalesce_window = 0.5
+        self.max_move_distance = 500  # Tello's maximum distance for a single move command (cm)
         self.max_queue_size = 5  # Maximum number of queued moves
+        
+        # Fixed-size ring of queued beats (DrumType); the oldest is overwritten when full
+        self._drum_ring = array('b', [0] * self.max_queue_size)
+        self._ring_head = 0  # Slot of the oldest queued beat
+        self._ring_count = 0
+        self._last_drum = None
         self.logger = logging.getLogger(__name__)
         
-        if not simulation_mode:
-            self.drone = Tello()
+        # Relative likelihood of each move name (default 1), e.g. {'flip_forward': 3}
+        move_weights = move_weights or {}
+        
+        # Precompute (move, value, kind) entries and their cumulative weights per drum type
+        # so each beat costs a single random draw
+        self._move_tables = tuple(
+            tuple((move, value, kind)
+                  for move in self._get_moves_for_drum(drum_type)
+                  for kind in (self._get_move_kind(move),)
+                  for value in self._get_values_for_move(kind))
+            for drum_type in DrumType
+        )
+        if any(weight < 0 for weight in move_weights.values()):
+            raise ValueError("Move weights must not be negative")
+        self._move_cdfs = tuple(
+            tuple(accumulate(move_weights.get(move, 1) for move, _, _ in table))
+            for table in self._move_tables
+        )
+        for drum_type, cdf in zip(DrumType, self._move_cdfs):
+            if cdf[-1] <= 0:
+                raise ValueError(f"Every move for {drum_type.name} has weight 0")
+        # Private generator so beat threads never contend on the random module's shared instance;
+        # pass a seed to replay the same dance
+        self._rng = random.Random(seed)
+        self._random = self._rng.random
+        
+        # Cache whether move details are logged so the beat path skips formatting entirely
+        self._dbg = self.logger.isEnabledFor(logging.DEBUG)
+        
+        # Preformatted descriptions for every (move, value) pair in the move tables
+        self._move_msgs = {(move, value): self._format_move(move, value)
+                           for table in self._move_tables for move, value, _ in table}
+        
+        # Simulated or real drone, chosen once so no method has to branch on the mode
+        if simulation_mode:
+            self._backend = _SimBackend()
+        else:
+            self._backend = _RealBackend(self.logger, self.max_queue_size)
             
+    @property
+    def current_height(self):
+        """Simulated height in cm; always 0 for a real drone"""
+        return self._backend.current_height
+        
     def connect(self):
         """Connect to the drone"""
-        if not self.simulation_mode:
-            self.drone.connect()
-            print("Connected to Tello drone")
-        else:
-            print("Drone connected (SIMULATION MODE)")
+        self._backend.connect()
             
     def takeoff(self):
         """Take off the drone"""
-        if not self.simulation_mode:
-            self.drone.takeoff()
-        else:
-            print("Taking off... (SIMULATION MODE)")
-            self.current_height = 100  # Initial height in cm
-            
+        self._backend.takeoff()
         self.is_flying = True
         print("Drone is airborne!")
         
     def land(self):
         """Land the drone"""
-        if not self.simulation_mode:
-            self.drone.land()
-        else:
-            print("Landing... (SIMULATION MODE)")
-            self.current_height = 0
-            
+        self._backend.land()
         self.is_flying = False
         print("Drone has landed")
         
@@ -55,160 +303,107 @@ class DroneController:
         if not self.is_flying:
             return
             
-        current_time = time.time()
-        print(f"\nQueuing dance move for {drum_type} (Queue size: {len(self.command_queue)})")
+        current_time = _mono()
+        last_command_time = self.last_command_time
+        drum = _DRUM_STR_TO_INT.get(drum_type, DrumType.OTHER)
         
-        # Add move to queue if not full
-        if len(self.command_queue) < self.max_queue_size:
-            self.command_queue.append((current_time, drum_type))
-            print(f"Move added to queue. New size: {len(self.command_queue)}")
-            
-            # If it's time for a new move, execute it
-            if current_time - self.last_command_time >= self.min_command_interval:
-                print("Executing move...")
-                self._execute_next_move()
-                
-    def _execute_next_move(self):
-        """Execute the next move in the queue"""
-        if not self.command_queue:
+        # Drop rapid repeats of the same drum; they would only queue another similar move
+        if drum == self._last_drum and current_time - last_command_time < self.coalesce_window:
             return
-            
-        # Update timing and get drum type
-        self.last_command_time, drum_type = self.command_queue.pop(0)
+        self._last_drum = drum
         
-        if self.simulation_mode:
-            self._perform_simulated_move(drum_type)
-        else:
-            self._perform_real_move(drum_type)
-            
-    def _get_moves_for_drum(self, drum_type):
-        """Get appropriate moves for each drum type"""
-        if drum_type == 'kick':
-            return ['move_up', 'move_down']  # Vertical movements for bass drums
-        elif drum_type == 'snare':
-            return ['move_left', 'move_right']  # Horizontal movements for snare
-        elif drum_type == 'hihat':
-            return ['rotate_clockwise', 'rotate_counter_clockwise']  # Rotations for hi-hats
-        elif drum_type == 'toms':
-            return ['move_forward', 'move_back']  # Forward/back for toms
+        # Add move to queue (overwriting the oldest move when full)
+        size = self.max_queue_size
+        count = self._ring_count
+        slot = (self._ring_head + count) % size
+        self._drum_ring[slot] = drum
+        if count < size:
+            self._ring_count = count + 1
         else:
-            return ['flip_forward', 'flip_back', 'flip_left', 'flip_right']  # Default flips
+            self._ring_head = (self._ring_head + 1) % size
+        if self._dbg:
+            self.logger.debug("Queued dance move for %s (queue size %d)", drum_type, self._ring_count)
+        
+        # If it's time for a new move, execute it
+        min_command_interval = self.min_command_interval
+        if current_time - last_command_time >= min_command_interval:
+            self._execute_queued_moves()
+                
+    def _execute_queued_moves(self):
+        """Execute every queued move, merging runs of identical moves into single commands"""
+        count = self._ring_count
+        if not count:
+            return
             
-    def _perform_simulated_move(self, drum_type='kick'):
-        """Execute a simulated dance move based on drum type"""
-        try:
-            print("\n=== Simulated Drone Move ===")
-            # Get moves appropriate for this drum type
-            possible_moves = self._get_moves_for_drum(drum_type)
-            move = random.choice(possible_moves)
+        # Drain the queue and pick a move for each queued beat
+        size = self.max_queue_size
+        head = self._ring_head
+        drum_ring = self._drum_ring
+        moves = [self._choose_move(drum_ring[(head + i) % size]) for i in range(count)]
+        self._ring_head = (head + count) % size
+        self._ring_count = 0
+        
+        do_move = self._backend.do_move
+        for move, value, kind in self._fuse_moves(moves):
+            if self._dbg:
+                self.logger.debug("%s: %s", self._backend.move_label, self._describe_move(move, value))
+            do_move(move, value, kind)
             
-            # Randomly choose a distance or angle
-            if 'rotate' in move:
-                value = random.choice([45, 90, 180])
+        # Space the next command from the end of this send
+        self.last_command_time = _mono()
+        
+    def _fuse_moves(self, moves):
+        """Merge consecutive identical moves so the drone receives fewer commands for the same motion"""
+        fused = []
+        for move, group in groupby(moves, key=itemgetter(0)):
+            group = list(group)
+            kind = group[0][2]
+            if kind == FLIP:
+                fused.append((move, None, FLIP))  # Repeated flips collapse into one
+            elif kind == ROTATE:
+                angle = sum(value for _, value, _ in group) % 360
+                if angle:  # Full turns cancel out
+                    fused.append((move, angle, ROTATE))
             else:
-                value = random.choice([20, 30, 50])
-            
-            # Log and print the move
-            print(f"Drum type: {drum_type.upper()}")
-            print(f"Executing move: {move}")
-            if 'flip' not in move:
-                print(f"Value: {value}")
-            self.logger.info(f"Simulated move for {drum_type}: {move} {'with value ' + str(value) if 'flip' not in move else ''}")
-            
-            # Simulate the move with clear visual feedback
-            if move == 'rotate_clockwise':
-                print(f" Rotating {value}° clockwise")
-            elif move == 'rotate_counter_clockwise':
-                print(f" Rotating {value}° counter-clockwise")
-            elif move == 'move_forward':
-                print(f" Moving forward {value}cm")
-            elif move == 'move_back':
-                print(f" Moving back {value}cm")
-            elif move == 'move_left':
-                print(f" Moving left {value}cm")
-            elif move == 'move_right':
-                print(f" Moving right {value}cm")
-            elif move == 'move_up':
-                print(f" Moving up {value}cm")
-                self.current_height += value
-            elif move == 'move_down':
-                print(f" Moving down {value}cm")
-                self.current_height = max(0, self.current_height - value)
-            elif move == 'flip_forward':
-                print(" Flipping forward")
-            elif move == 'flip_back':
-                print(" Flipping back")
-            elif move == 'flip_left':
-                print(" Flipping left")
-            elif move == 'flip_right':
-                print(" Flipping right")
-            
-            print(f"Current height: {self.current_height}cm")
-            print("=== Move Complete ===\n")
+                distance = sum(value for _, value, _ in group)
+                fused.append((move, min(distance, self.max_move_distance), MOVE))
+        return fused
             
-        except Exception as e:
-            print(f"Error simulating move: {e}")
-
-    def _perform_real_move(self, drum_type='kick'):
-        """Execute a real dance move based on drum type"""
-        try:
-            print("\n=== Real Drone Move ===")
-            # Get moves appropriate for this drum type
-            possible_moves = self._get_moves_for_drum(drum_type)
-            move = random.choice(possible_moves)
-            
-            # Randomly choose a distance or angle
-            if 'rotate' in move:
-                value = random.choice([45, 90, 180])
-            else:
-                value = random.choice([20, 30, 50])
+    def _get_moves_for_drum(self, drum_type):
+        """Get appropriate moves for a DrumType"""
+        return _DRUM_MOVES[drum_type]
             
-            # Log and print the move
-            print(f"Drum type: {drum_type.upper()}")
-            print(f"Executing move: {move}")
-            if 'flip' not in move:
-                print(f"Value: {value}")
-            self.logger.info(f"Real drone move for {drum_type}: {move} {'with value ' + str(value) if 'flip' not in move else ''}")
+    def _get_move_kind(self, move):
+        """Classify a move name as MOVE, ROTATE or FLIP"""
+        if 'flip' in move:
+            return FLIP
+        elif 'rotate' in move:
+            return ROTATE
+        else:
+            return MOVE
             
-            # Execute the move
-            if move == 'rotate_clockwise':
-                print(f" Rotating {value}° clockwise")
-                self.drone.rotate_clockwise(value)
-            elif move == 'rotate_counter_clockwise':
-                print(f" Rotating {value}° counter-clockwise")
-                self.drone.rotate_counter_clockwise(value)
-            elif move == 'move_forward':
-                print(f" Moving forward {value}cm")
-                self.drone.move_forward(value)
-            elif move == 'move_back':
-                print(f" Moving back {value}cm")
-                self.drone.move_back(value)
-            elif move == 'move_left':
-                print(f" Moving left {value}cm")
-                self.drone.move_left(value)
-            elif move == 'move_right':
-                print(f" Moving right {value}cm")
-                self.drone.move_right(value)
-            elif move == 'move_up':
-                print(f" Moving up {value}cm")
-                self.drone.move_up(value)
-            elif move == 'move_down':
-                print(f" Moving down {value}cm")
-                self.drone.move_down(value)
-            elif move == 'flip_forward':
-                print(" Flipping forward")
-                self.drone.flip_forward()
-            elif move == 'flip_back':
-                print(" Flipping back")
-                self.drone.flip_back()
-            elif move == 'flip_left':
-                print(" Flipping left")
-                self.drone.flip_left()
-            elif move == 'flip_right':
-                print(" Flipping right")
-                self.drone.flip_right()
+    def _get_values_for_move(self, kind):
+        """Get the possible distances (cm) or angles (degrees) for a kind of move"""
+        if kind == FLIP:
+            return (None,)  # Flips take no value
+        elif kind == ROTATE:
+            return (45, 90, 180)
+        else:
+            return (20, 30, 50)
             
-            print("=== Move Complete ===\n")
+    def _choose_move(self, drum_type):
+        """Pick a weighted random (move, value, kind) entry for a DrumType from the precomputed tables"""
+        cdf = self._move_cdfs[drum_type]
+        # random() * total can round up to total with float weights; hi keeps the index in range
+        return self._move_tables[drum_type][bisect_right(cdf, self._random() * cdf[-1], 0, len(cdf) - 1)]
             
-        except Exception as e:
-            print(f"Error executing move: {e}")
+    def _format_move(self, move, value):
+        """Build the human-readable description of a move"""
+        return _MOVE_DESCRIPTIONS[move].format(value)
+        
+    def _describe_move(self, move, value):
+        """Look up the description of a move, caching those for fused values"""
+        msg = self._move_msgs.get((move, value))
+        if msg is None:
+            msg = self._move_msgs[(move, value)] = self._format_move(move, value)
+        return msg
@@ -1,10 +1,41 @@
-import pyaudio
+import ctypes
+import sys
 import numpy as np
 import time
 import threading
-from queue import Queue, Empty
 import logging
-from scipy.signal import butter, lfilter
+from numba import njit
+from scipy.fft import rfft, next_fast_len
+
+@njit(cache=True, nogil=True, fastmath=True)
+def _detect_kernel(power, bin_lo, bin_hi, scale, history, hist_sum, hist_idx, hist_len,
+                   thresholds, min_trigger, energies, active):
+    """Update each band's energy history from a power spectrum and flag bands with a hit.
+    
+    Writes the band energies into `energies` and a 0/1 hit mask into `active`.
+    Returns True if any band is above its minimum trigger energy.
+    """
+    significant = False
+    for b in range(bin_lo.size):
+        total = 0.0
+        for k in range(bin_lo[b], bin_hi[b]):
+            total += power[k]
+        # Round to the history's float32 first, so the value added to the running sum is
+        # exactly the one subtracted when it leaves the ring
+        energy = np.float32(total * scale)
+        
+        # Store energy history and keep a running sum, so the average includes the current chunk
+        hist_sum[b] += energy
+        hist_sum[b] -= history[b, hist_idx]
+        history[b, hist_idx] = energy
+        avg_energy = hist_sum[b] / hist_len
+        
+        energies[b] = energy
+        above_min = energy > min_trigger[b]
+        if above_min:
+            significant = True
+        active[b] = 1 if above_min and energy > avg_energy + thresholds[b] else 0
+    return significant
 
 class RealTimeBeatDetector:
     def __init__(self, device_index=None):
@@ -13,21 +44,36 @@ class RealTimeBeatDetector:
         self.logger = logging.getLogger(__name__)
         
         # Audio parameters
-        self.CHUNK = 2048
-        self.FORMAT = pyaudio.paFloat32
+        self.CHUNK = 4096  # Samples per analysis chunk (~93 ms; ~11 Hz FFT bins for the kick band)
+        self.FRAMES_PER_BUFFER = 512  # Samples per PortAudio callback; CHUNK must be a multiple of it
+        self.FORMAT = None  # pyaudio.paFloat32, resolved when start() imports PyAudio
+        self._pa_continue = None  # pyaudio.paContinue, resolved likewise
         self.CHANNELS = 1
         self.RATE = 44100
         self.device_index = device_index
-        self.audio_queue = Queue(maxsize=10)
+        
+        # Preallocated ring of audio chunks shared by the PortAudio callback (writer) and
+        # the processing thread (reader); the counters only ever grow
+        self.ring_slots = 16
+        self._ring = np.empty((self.ring_slots, self.CHUNK), dtype=np.float32)
+        self._ring_write = 0
+        self._ring_read = 0
+        self._ring_fill = 0  # Samples already written into the slot being filled
+        self._ring_addr = self._ring.ctypes.data  # Base address for copying raw callback bytes
+        self._chunk_ready = threading.Event()  # Set by the callback each time it publishes a chunk
         
         # Beat detection parameters
         self.energy_threshold = 0.0003
         self.min_beat_interval = 0.3
-        self.last_beat_time = 0
         self.beat_count = 0
-        self.last_visualization_time = 0
         self.visualization_interval = 0.1
         
+        # Timing gates use integer nanoseconds from the monotonic clock
+        self.min_beat_interval_ns = int(self.min_beat_interval * 1e9)
+        self.visualization_interval_ns = int(self.visualization_interval * 1e9)
+        self.last_beat_ns = 0
+        self.last_visualization_ns = 0
+        
         # Frequency bands for drum detection
         self.freq_bands = {
             'kick': (50, 100),      # Bass drum
@@ -36,9 +82,28 @@ class RealTimeBeatDetector:
             'toms': (100, 300),     # Tom drums
         }
         
-        # Band energy history
-        self.band_energies = {band: [] for band in self.freq_bands}
-        self.history_size = 20
+        # FFT length, zero-padded up to a size pocketfft handles quickly (4096 already is)
+        self.nfft = next_fast_len(self.CHUNK, real=True)
+        # FFT bin range covering each band, so one FFT per chunk yields every band energy
+        self.band_bins = {band: (int(low * self.nfft / self.RATE), int(high * self.nfft / self.RATE) + 1)
+                          for band, (low, high) in self.freq_bands.items()}
+        # Hann window so a chunk's hard edges don't smear energy into neighbouring bands
+        self._window = np.hanning(self.CHUNK).astype(np.float32)
+        # Scratch for windowed chunks, one row per ring slot, so batches don't allocate
+        self._windowed = np.empty((self.ring_slots, self.CHUNK), dtype=np.float32)
+        # Parseval scaling from one-sided windowed FFT power to mean signal power
+        self.fft_scale = 2.0 / (self.nfft * float(np.sum(self._window * self._window)))
+        # Upper bound on any band's energy per unit of chunk sum-of-squares, for the silence check
+        self._silence_scale = 2.0 / float(np.sum(self._window * self._window))
+        self._silent_power = np.zeros(self.nfft // 2 + 1, dtype=np.float32)
+        
+        # Band energy history: one ring buffer row per band
+        self.history_size = 10  # ~0.9 s of chunks
+        self._band_names = tuple(self.freq_bands)
+        self._history = np.zeros((len(self._band_names), self.history_size), dtype=np.float32)
+        self._history_sum = np.zeros(len(self._band_names))  # float64, sum of the float32 entries in _history
+        self._history_idx = 0
+        self._history_len = 0
         self.min_active_bands = 1  # Reduced to detect individual drum hits
         
         # Drum-specific thresholds and minimum energies
@@ -57,73 +122,82 @@ class RealTimeBeatDetector:
             'toms': 0.1      
         }
         
+        # Dense per-band arrays for the detection kernel, in _band_names order
+        self._bin_lo = np.array([self.band_bins[band][0] for band in self._band_names], dtype=np.int64)
+        self._bin_hi = np.array([self.band_bins[band][1] for band in self._band_names], dtype=np.int64)
+        self._thresholds = np.array([self.drum_thresholds[band] for band in self._band_names], dtype=np.float32)
+        self._min_trigger = np.array([self.min_trigger_energy[band] for band in self._band_names], dtype=np.float32)
+        self._energies = np.zeros(len(self._band_names), dtype=np.float32)
+        self._active = np.zeros(len(self._band_names), dtype=np.int8)
+        
+        # Latest band energies for the visualization thread, which does all the printing
+        self._viz_snapshot = np.zeros(len(self._band_names), dtype=np.float32)
+        self._viz_event = threading.Event()
+        
         # Control flags
         self.is_running = False
+        self._stop_event = threading.Event()  # Set by stop() to release start()
         self.beat_callbacks = []
         
-    def butter_bandpass(self, lowcut, highcut, order=4):
-        """Create a butterworth bandpass filter"""
-        nyq = 0.5 * self.RATE
-        low = lowcut / nyq
-        high = highcut / nyq
-        b, a = butter(order, [low, high], btype='band')
-        return b, a
-        
-    def bandpass_filter(self, data, lowcut, highcut, order=4):
-        """Apply bandpass filter to the data"""
-        b, a = self.butter_bandpass(lowcut, highcut, order=order)
-        y = lfilter(b, a, data)
-        return y
-        
-    def get_band_energy(self, data, band_name):
-        """Get the energy in a specific frequency band"""
-        low, high = self.freq_bands[band_name]
-        filtered_data = self.bandpass_filter(data, low, high)
-        return np.sqrt(np.mean(np.square(filtered_data)))
-        
     def detect_beats(self, audio_data):
         """Detect beats in the audio data"""
+        self.detect_beats_batched(audio_data[np.newaxis])
+        
+    def detect_beats_batched(self, batch):
+        """Detect beats in consecutive audio chunks, given as rows of a 2-D array"""
         try:
-            # Apply bandpass filters and calculate energy for each band
-            band_energies = {}
-            active_bands = []
-            significant_activity = False  # Flag for significant energy detection
+            # Chunks too quiet for any band to reach its minimum trigger energy skip the FFT
+            loud = np.einsum('ij,ij->i', batch, batch) * self._silence_scale >= self._min_trigger.min()
+            if not loud.all():
+                batch = batch[loud]
             
-            for band, (low, high) in self.freq_bands.items():
-                filtered = self.bandpass_filter(audio_data, low, high)
-                energy = np.sum(filtered * filtered) / len(filtered)
-                band_energies[band] = energy
-                
-                # Store energy history
-                self.band_energies[band].append(energy)
-                if len(self.band_energies[band]) > self.history_size:
-                    self.band_energies[band].pop(0)
-                
-                # Calculate average energy for this band
-                avg_energy = np.mean(self.band_energies[band])
-                
-                # Check if energy is above minimum threshold for movement
-                if energy > self.min_trigger_energy[band]:
-                    significant_activity = True
-                
-                # Use drum-specific thresholds
-                threshold = self.drum_thresholds[band]
-                
-                # Check if this band has a beat and enough energy
-                if energy > avg_energy + threshold and energy > self.min_trigger_energy[band]:
-                    active_bands.append(band)
-                    self.logger.info(f"{band.upper()} hit detected! Energy: {energy:.6f}")
+            # One multi-threaded FFT call covers every chunk in the batch; the windowed
+            # copy is scratch, so scipy may transform it in place
+            if len(batch) <= self.ring_slots:
+                windowed = np.multiply(batch, self._window, out=self._windowed[:len(batch)])
+            else:
+                windowed = batch * self._window
+            spectra = rfft(windowed, n=self.nfft, axis=1, overwrite_x=True, workers=-1)
+            powers = iter(spectra.real * spectra.real + spectra.imag * spectra.imag)
+        except Exception as e:
+            self.logger.error("Error in beat detection: %s", e)
+            return
+            
+        # Silent chunks still advance the history, as zero energy
+        for is_loud in loud:
+            self._detect_beats_in_power(next(powers) if is_loud else self._silent_power)
+            
+    def _detect_beats_in_power(self, power):
+        """Detect beats in one chunk's power spectrum"""
+        try:
+            # Update band histories and find bands with a hit in one compiled pass
+            self._history_len = min(self._history_len + 1, self.history_size)
+            significant_activity = _detect_kernel(
+                power, self._bin_lo, self._bin_hi, self.fft_scale,
+                self._history, self._history_sum, self._history_idx, self._history_len,
+                self._thresholds, self._min_trigger, self._energies, self._active)
+            self._history_idx = (self._history_idx + 1) % self.history_size
+            
+            active_bands = []
+            log_hits = self.logger.isEnabledFor(logging.INFO)
+            for i in np.flatnonzero(self._active):
+                band = self._band_names[i]
+                active_bands.append(band)
+                if log_hits:
+                    self.logger.info("%s hit detected! Energy: %.6f", band.upper(), self._energies[i])
             
             # Only visualize if there's significant activity
-            current_time = time.time()
-            if current_time - self.last_visualization_time >= self.visualization_interval:
+            now_ns = time.monotonic_ns()
+            if now_ns - self.last_visualization_ns >= self.visualization_interval_ns:
                 if significant_activity:
-                    self._visualize_drum_energies(band_energies)
-                self.last_visualization_time = current_time
+                    # Hand a snapshot to the visualization thread instead of printing here
+                    self._viz_snapshot[:] = self._energies
+                    self._viz_event.set()
+                self.last_visualization_ns = now_ns
             
             # Trigger callback if any drum is detected with sufficient energy
-            if active_bands and time.time() - self.last_beat_time >= self.min_beat_interval:
-                self.last_beat_time = time.time()
+            if active_bands and now_ns - self.last_beat_ns >= self.min_beat_interval_ns:
+                self.last_beat_ns = now_ns
                 self.beat_count += 1
                 
                 # Call all registered callbacks with the detected drum type
@@ -131,43 +205,83 @@ class RealTimeBeatDetector:
                     callback(active_bands[0])  
                 
         except Exception as e:
-            self.logger.error(f"Error in beat detection: {e}")
+            self.logger.error("Error in beat detection: %s", e)
+            
+    def _visualization_loop(self):
+        """Print the drum monitor whenever the detector publishes a new energy snapshot"""
+        # Print initial empty visualization
+        print("\n" * 8)
+        
+        while self.is_running:
+            if not self._viz_event.wait(timeout=0.5):
+                continue
+            self._viz_event.clear()
+            if not self.is_running:
+                break
+            self._visualize_drum_energies(self._viz_snapshot.copy())
             
     def _visualize_drum_energies(self, energies):
-        """Visualize the energy levels of different drum components"""
-        print("\n=== Drum Monitor ===")
-        for band, energy in energies.items():
-            if energy > self.min_trigger_energy[band] * 0.5:  # Show only if energy is significant
+        """Visualize the energy levels of different drum components, given in _band_names order"""
+        # Build the whole frame and write it at once, so stdout is locked once per frame
+        lines = ["", "=== Drum Monitor ==="]
+        for band, energy, min_trigger in zip(self._band_names, energies.tolist(), self._min_trigger.tolist()):
+            if energy > min_trigger * 0.5:  # Show only if energy is significant
                 bars = int(min(energy * 50000, 30))  # Scale factor adjusted for visualization
-                threshold_bars = int(self.min_trigger_energy[band] * 50000)
-                print(f"{band.upper():6} {'█' * bars}{' ' * (30 - bars)} | Energy: {energy:.6f}")
-                print(f"       {' ' * threshold_bars}↑ Min Threshold")
-        active_count = sum(1 for band, energy in energies.items() if energy > self.min_trigger_energy[band])
-        print(f"Total Beats: {self.beat_count} | Active Drums: {active_count}/4")
+                threshold_bars = int(min_trigger * 50000)
+                lines.append(f"{band.upper():6} {'█' * bars}{' ' * (30 - bars)} | Energy: {energy:.6f}")
+                lines.append(f"       {' ' * threshold_bars}↑ Min Threshold")
+        active_count = int(np.count_nonzero(energies > self._min_trigger))
+        lines.append(f"Total Beats: {self.beat_count} | Active Drums: {active_count}/4\n")
+        sys.stdout.write("\n".join(lines))
+        sys.stdout.flush()
+        
+    def _warm_up_kernel(self):
+        """Compile the detection kernel up front so the first audio chunk isn't delayed"""
+        _detect_kernel(self._silent_power, self._bin_lo, self._bin_hi, self.fft_scale,
+                       self._history.copy(), self._history_sum.copy(), 0, 1, self._thresholds, self._min_trigger,
+                       self._energies.copy(), self._active.copy())
         
     def process_audio(self):
-        """Process audio data from queue"""
-        # Print initial empty visualization
-        print("\n" * 8)
+        """Process audio chunks from the ring buffer"""
+        # Bind loop-invariant attributes once; only the write counter changes under us
+        ring = self._ring
+        slots = self.ring_slots
+        detect = self.detect_beats_batched
+        chunk_ready = self._chunk_ready
+        read = self._ring_read
         
         while self.is_running:
             try:
-                try:
-                    audio_data = self.audio_queue.get(timeout=0.1)
-                except Empty:
+                write = self._ring_write
+                if read == write:
+                    # Sleep until the callback publishes a chunk
+                    chunk_ready.wait(timeout=0.1)
+                    chunk_ready.clear()
                     continue
                 
+                # If the callback has lapped us, skip to the oldest complete chunk still in the ring;
+                # slot write % slots is the one it is filling now, so never read that one
+                if write - read >= slots:
+                    read = write - slots + 1
+                    
+                # Take every pending chunk up to the end of the ring as one batch
+                start = read % slots
+                count = min(write - read, slots - start)
+                read += count
+                self._ring_read = read
+                
                 # Detect musical beats
-                self.detect_beats(audio_data)
+                detect(ring[start:start + count])
                 
             except Exception as e:
                 if not self.is_running:
                     break
-                self.logger.error(f"Error processing audio: {e}")
+                self.logger.error("Error processing audio: %s", e)
                 time.sleep(0.1)
                 
     def find_input_device(self):
         """Find the best input device"""
+        import pyaudio
         p = pyaudio.PyAudio()
         try:
             
@@ -176,34 +290,41 @@ class RealTimeBeatDetector:
                 try:
                     device_info = p.get_device_info_by_index(i)
                     if device_info['maxInputChannels'] > 0:
-                        self.logger.info(f"\nSelected input device {i}: {device_info['name']}")
+                        self.logger.info("\nSelected input device %d: %s", i, device_info['name'])
                         return i
                 except:
                     continue
             
             # If no device found, try default
             default_device = p.get_default_input_device_info()
-            self.logger.info(f"\nUsing default device: {default_device['name']}")
+            self.logger.info("\nUsing default device: %s", default_device['name'])
             return default_device['index']
             
         except Exception as e:
-            self.logger.error(f"Error finding input device: {e}")
+            self.logger.error("Error finding input device: %s", e)
             raise
         finally:
             p.terminate()
         
     def audio_callback(self, in_data, frame_count, time_info, status):
         if status:
-            self.logger.warning(f"Audio callback status: {status}")
+            self.logger.warning("Audio callback status: %s", status)
         
         if self.is_running:
-            try:
-                audio_data = np.frombuffer(in_data, dtype=np.float32)
-                if not self.audio_queue.full():
-                    self.audio_queue.put_nowait(audio_data)
-            except Exception as e:
-                self.logger.error(f"Error in audio callback: {e}")
-        return (in_data, pyaudio.paContinue)
+            # Copy the raw bytes straight into the slot being filled; no queue, lock or new
+            # array per callback. The slot is published to the processing thread once it
+            # holds a full CHUNK.
+            fill = self._ring_fill
+            offset = (self._ring_write % self.ring_slots) * self.CHUNK + fill
+            nbytes = min(len(in_data), (self.CHUNK - fill) * 4)  # float32 samples; never overrun the slot
+            ctypes.memmove(self._ring_addr + offset * 4, in_data, nbytes)
+            fill += nbytes // 4
+            if fill >= self.CHUNK:
+                fill = 0
+                self._ring_write += 1
+                self._chunk_ready.set()
+            self._ring_fill = fill
+        return (in_data, self._pa_continue)
         
     def start(self):
         """Start beat detection"""
@@ -212,20 +333,31 @@ class RealTimeBeatDetector:
             
         self.logger.info("\nInitializing beat detection...")
         self.is_running = True
+        self._stop_event.clear()
         
         try:
-            # Initialize PyAudio
+            # Initialize PyAudio; imported here so loading this module doesn't initialize the audio host
+            import pyaudio
+            self.FORMAT = pyaudio.paFloat32
+            self._pa_continue = pyaudio.paContinue
             self.p = pyaudio.PyAudio()
             
             # Find input device if not specified
             if self.device_index is None:
                 self.device_index = self.find_input_device()
                 
+            self._warm_up_kernel()
+                
             # Start processing thread
             self.process_thread = threading.Thread(target=self.process_audio)
             self.process_thread.daemon = True
             self.process_thread.start()
             
+            # Start visualization thread
+            self.viz_thread = threading.Thread(target=self._visualization_loop)
+            self.viz_thread.daemon = True
+            self.viz_thread.start()
+            
             # Open stream
             self.stream = self.p.open(
                 format=self.FORMAT,
@@ -233,7 +365,7 @@ class RealTimeBeatDetector:
                 rate=self.RATE,
                 input=True,
                 input_device_index=self.device_index,
-                frames_per_buffer=self.CHUNK,
+                frames_per_buffer=self.FRAMES_PER_BUFFER,
                 stream_callback=self.audio_callback
             )
             
@@ -245,12 +377,13 @@ class RealTimeBeatDetector:
             print("1. Play music near your microphone")
             print("2. Press Ctrl+C to stop\n")
             
-            # Keep the stream running
-            while self.is_running:
-                time.sleep(0.1)
+            # Keep the stream running until stop(); the timeout only keeps Ctrl+C
+            # responsive on Windows, where an untimed wait can't be interrupted
+            while not self._stop_event.wait(timeout=1.0):
+                pass
                 
         except Exception as e:
-            self.logger.error(f"Error in beat detection: {e}")
+            self.logger.error("Error in beat detection: %s", e)
             self.stop()
             raise
             
@@ -258,23 +391,29 @@ class RealTimeBeatDetector:
         """Stop beat detection"""
         self.logger.info("Stopping beat detection...")
         self.is_running = False
+        self._stop_event.set()
         
         if self.stream:
             try:
                 self.stream.stop_stream()
                 self.stream.close()
             except Exception as e:
-                self.logger.error(f"Error stopping stream: {e}")
+                self.logger.error("Error stopping stream: %s", e)
         
         if self.p:
             try:
                 self.p.terminate()
             except Exception as e:
-                self.logger.error(f"Error terminating PyAudio: {e}")
+                self.logger.error("Error terminating PyAudio: %s", e)
             
         if hasattr(self, 'process_thread'):
+            self._chunk_ready.set()  # Wake it so it sees is_running is False
             self.process_thread.join(timeout=1.0)
             
+        if hasattr(self, 'viz_thread'):
+            self._viz_event.set()  # Wake it so it sees is_running is False
+            self.viz_thread.join(timeout=1.0)
+            
     def add_beat_callback(self, callback):
         """Add a function to be called when a beat is detected"""
         self.beat_callbacks.append(callback)